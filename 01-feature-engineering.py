@@ -1,28 +1,126 @@
 from io import RawIOBase
 import os
 import json
+import importlib
+import scipy.sparse
+from bisect import bisect_left, bisect_right
+
+# same as "from event-store import load_user_mapping, UserEvents"
+load_user_mapping = importlib.import_module('event-store').load_user_mapping
+UserEvents = importlib.import_module('event-store').UserEvents
+
+
+class ReserveFeatures:
+    """
+        Accumulates per reserve / per asset features as rows of a sparse matrix.
+
+        a user only touches a few of the dozens of reserves, so these are kept
+        as CSR rows instead of dense feature columns. Columns are assigned as
+        new (kind, id, stat) keys show up, pass the columns of the training
+        set to the test set so both share the same layout:
+
+            R_tr = ReserveFeatures()
+            R_te = ReserveFeatures(R_tr.columns)
+
+        set grow=False to keep a fixed layout, e.g. the one a model was
+        trained on, keys without a column are then dropped.
+    """
+
+    def __init__(self, columns=None, grow=True):
+        self.columns = {} if columns is None else columns
+        self.grow = grow
+        self.indptr = [0]
+        self.indices = []
+        self.data = []
+
+    def add_row(self, reserve_feats):
+        """
+            append one row, reserve_feats as returned by get_features_and_label(..., per_reserve=True)
+        """
+        for key, value in reserve_feats.items():
+            if not value: continue
+            if not self.grow and key not in self.columns: continue
+            self.indices.append(self.columns.setdefault(key, len(self.columns)))
+            self.data.append(float(value))
+        self.indptr.append(len(self.indices))
+
+    def to_csr(self):
+        """
+            rows added so far as a CSR matrix, wide enough for every column seen so far.
+        """
+        return scipy.sparse.csr_matrix(
+            (self.data, self.indices, self.indptr),
+            shape=(len(self.indptr) - 1, len(self.columns)),
+        )
+
+    def column_keys(self, table=None):
+        """
+            (kind, id, stat) keys in column order, `table` decodes the ids of an EventStore.
+        """
+        keys = [None] * len(self.columns)
+        for (kind, key, stat), idx in self.columns.items():
+            keys[idx] = (kind, table[key] if table is not None else key, stat)
+        return keys
+
+    def feature_names(self, table=None):
+        """
+            column names in column order, `table` decodes the ids of an EventStore.
+        """
+        return [f"{kind}_{key}_{stat}" for kind, key, stat in self.column_keys(table)]
+
+
+# event fields the features are built from, in the order the loop below unpacks them
+_FEATURE_FIELDS = (
+    "event_type", "pool_id", "reserve_id", "reserve_symbol",
+    "amount", "amountAfterFee", "collateralAmount", "borrowRate",
+    "collateralReserve_underlyingAsset", "principalReserve_underlyingAsset", "principalAmount",
+)
+
+def get_features_and_label (evs, timestamp, per_reserve=False):
+    """
+        build the feature map and label for a user's events at a given timestamp.
+
+        evs can be a list of event dicts, or UserEvents from an event-store.py
+        EventStore. Those are sorted by timestamp, so the windows are found by
+        bisection and the loop runs over their columns.
+
+        with per_reserve set, also returns sparse per reserve / per asset
+        features from the same pass, as {(kind, id, stat): value}:
+            ("reserve", reserve_id, "num" | "sum" | "borrow_share")
+            ("asset", underlyingAsset, "liq_collateral_sum" | "liq_principal_sum")
+        use ReserveFeatures to collect them into a sparse matrix.
+    """
+    past_window = 180*24*60*60 # 180 days in seconds
+    fut_window = 90*24*60*60 # 90 days in seconds
 
+    if isinstance(evs, UserEvents):
+        columns = evs.columns
+        ts = columns["timestamp"]
 
-# This could be made more efficient without re-traversing the list
-# comprehensions every time, but it's not a bottleneck for data at this volume
+        # trailing 180 days before this timestamp, and the 90 days after it (exclude ==)
+        past_start, past_stop = bisect_left(ts, timestamp - past_window), bisect_left(ts, timestamp)
+        near_start, near_stop = bisect_right(ts, timestamp), bisect_right(ts, timestamp + fut_window)
 
-def get_features_and_label (evs, timestamp):
-  
-    # split events into ones before and after this timestamp (exclude ==)
-    prev_evs = [e for e in evs if e["timestamp"] < timestamp]
-    fut_evs = [e for e in evs if e["timestamp"] > timestamp]
+        past = [columns[key][past_start:past_stop] for key in _FEATURE_FIELDS]
+        near_liqs = [typ for typ in columns["event_type"][near_start:near_stop] if typ == "liquidation_call"]
 
-    # restrict past events to trailing 180 days (~6 months)
-    past_window = 180*24*60*60 # 180 days in seconds
-    past_evs = [e for e in prev_evs if e["timestamp"] >= timestamp - past_window]
+    else:
+        # split events into ones before and after this timestamp (exclude ==)
+        prev_evs = [e for e in evs if e["timestamp"] < timestamp]
+        fut_evs = [e for e in evs if e["timestamp"] > timestamp]
 
-    # from future events, get the ones in the next 90 days from timestamp
-    fut_window = 90*24*60*60 # 90 days in seconds
-    near_evs = [e for e in fut_evs if e["timestamp"] <= timestamp + fut_window]
+        # restrict past events to trailing 180 days (~6 months)
+        past_evs = [e for e in prev_evs if e["timestamp"] >= timestamp - past_window]
+
+        # from future events, get the ones in the next 90 days from timestamp
+        near_evs = [e for e in fut_evs if e["timestamp"] <= timestamp + fut_window]
+        near_liqs = [e for e in near_evs if e["event_type"] == "liquidation_call"]
+
+        # same columns as UserEvents, None where an event doesn't have the field
+        past = [[e.get(key) for e in past_evs] for key in _FEATURE_FIELDS]
 
     # this is our training label, liquidation in the "near" future.
     # careful note: 1 means "credit_ok", which means *no* near term liquidation.
-    near_liqs = [e for e in near_evs if e["event_type"] == "liquidation_call"]
     credit_ok = 1 if len(near_liqs) == 0 else 0
 
     # start assembling a feature map
@@ -33,6 +131,10 @@ def get_features_and_label (evs, timestamp):
     # number and volume of past transactions by type
     types = "unknown deposit liquidation_call repay borrow".split()
 
+    # counts and sums for each event type, filled in a single pass over past events
+    nums = dict.fromkeys(types, 0)
+    sums = dict.fromkeys(types, 0)
+
     # use this to calculated a blended historical interest rate
     wsum_interest = 0.0 # rate * amount (numerator for weighted avg)
     wsum = 0.0 # sum of amounts (denominator for weighted avg)
@@ -42,44 +144,59 @@ def get_features_and_label (evs, timestamp):
     reserves = {}
     symbols = {}
 
-    for typ in types:
-        # for each event type get sums, nums (counts), and averages
-        num_past_events = 0
-        sum_past_events = 0
+    # per reserve / per asset exposure, only the ones this user touched
+    reserve_feats = {}
 
-        for e in past_evs:
-            # use for tracking distinct pool and reserve data
-            if "pool_id" in e: pools[e["pool_id"]] = True
-            if "reserve_id" in e: reserves[e["reserve_id"]] = True
-            if "reserve_symbol" in e: symbols[e["reserve_symbol"]] = True
+    for (typ, pool, reserve, symbol, amount, amount_after_fee, collateral_amount, borrow_rate,
+            collateral_asset, principal_asset, principal_amount) in zip(*past):
+        # use for tracking distinct pool and reserve data
+        if pool is not None: pools[pool] = True
+        if reserve is not None: reserves[reserve] = True
+        if symbol is not None: symbols[symbol] = True
 
-            # break early if past event doesnt match types we are aggregating
-            if e["event_type"] != typ: continue
+        # skip past events that dont match types we are aggregating
+        if typ not in nums: continue
 
-            # add to count of past events
-            num_past_events += 1.0
+        # add to count of past events
+        nums[typ] += 1.0
 
-            # handle adding to sum of past events (ones that contain an "amount" value)
-            for amnt in "amount amountAfterFee collateralAmount".split():
-                if amnt in e:
-                    sum_past_events += int(e[amnt])
-                    break
+        # handle adding to sum of past events (the first of amount, amountAfterFee, collateralAmount they have)
+        value = amount if amount is not None else amount_after_fee if amount_after_fee is not None else collateral_amount
+        value = 0 if value is None else int(value)
+        sums[typ] += value
 
-            # handle interest (check borrows only for now)
-            if typ != "borrow": continue
+        if per_reserve:
+            # liquidations carry the collateral and principal assets instead of a reserve
+            if typ == "liquidation_call":
+                if collateral_asset is not None:
+                    key = ("asset", collateral_asset, "liq_collateral_sum")
+                    reserve_feats[key] = reserve_feats.get(key, 0) + int(collateral_amount)
+                if principal_asset is not None:
+                    key = ("asset", principal_asset, "liq_principal_sum")
+                    reserve_feats[key] = reserve_feats.get(key, 0) + int(principal_amount)
 
-            # change ray units to decimals, ray is 27 decimals of precision:
-                # https://docs.aave.com/developers/v/1.0/developing-on-aave/important-considerations#ray-math
+            elif reserve is not None:
+                for stat, stat_value in (("num", 1), ("sum", value), ("borrow_sum", value if typ == "borrow" else 0)):
+                    key = ("reserve", reserve, stat)
+                    reserve_feats[key] = reserve_feats.get(key, 0) + stat_value
 
-            rate = float(e["borrowRate"])
+        # handle interest (check borrows only for now)
+        if typ != "borrow": continue
 
-            # sum numerator and denominator for calculating weighted avg
-            wsum_interest += rate * float(e["amount"])
-            wsum += float(e["amount"])
+        # change ray units to decimals, ray is 27 decimals of precision:
+            # https://docs.aave.com/developers/v/1.0/developing-on-aave/important-considerations#ray-math
 
-        # find blended interest rate with sums from past events
-        weighted_interest = wsum_interest / max(1.0, wsum)
+        rate = float(borrow_rate)
+        amount = float(amount)
 
+        # sum numerator and denominator for calculating weighted avg
+        wsum_interest += rate * amount
+        wsum += amount
+
+    for typ in types:
+        # for each event type get sums, nums (counts), and averages
+        num_past_events = nums[typ]
+        sum_past_events = sums[typ]
 
         # update averages, sums, nums, and weighted interest to feature map
         avg_past_events = sum_past_events/max(1.0, float(num_past_events))
@@ -89,14 +206,24 @@ def get_features_and_label (evs, timestamp):
             feats[typ + "_avg"] = avg_past_events
 
         if typ == "borrow":
-            feats["weighted_interest"] = weighted_interest
+            # find blended interest rate with sums from past events
+            feats["weighted_interest"] = wsum_interest / max(1.0, wsum)
 
     # update unique values for pools and reserves.
     feats["num_pools"] = len(pools)
     feats["num_reserves"] = len(reserves)
     feats["num_symbols"] = len(symbols)
 
-    return feats
+    if not per_reserve:
+        return feats
+
+    # turn per reserve borrow sums into the share of that reserve's volume that was borrowed
+    for kind, reserve, stat in list(reserve_feats):
+        if stat != "borrow_sum": continue
+        borrow_sum = reserve_feats.pop((kind, reserve, stat))
+        reserve_feats[(kind, reserve, "borrow_share")] = borrow_sum / max(1.0, reserve_feats[(kind, reserve, "sum")])
+
+    return feats, reserve_feats
 
 if __name__ == "__main__":
 
@@ -104,8 +231,7 @@ if __name__ == "__main__":
     data_file = os.getcwd() + '/data/all_user_mapping.json'
     if os.path.isfile(data_file):
         print("\"all_user_mapping.json\" found, loading from disk.")
-        with open("./data/all_user_mapping.json") as f:
-            users = json.load(f)
+        users = load_user_mapping("./data/all_user_mapping.json")
     elif os.path.isfile(data_file) == False:
         raise FileNotFoundError("User mapping file \"all_user_mapping.json\" not present in data directory. Try running `graphql_fetcher.py` to retrieve and store the data.")
 
@@ -113,13 +239,12 @@ if __name__ == "__main__":
     # build feature dict for all events for a given user in the user mapping
     for usr in users:
         print(f"extracting features for user:{usr}...")
-        evs = users[usr]
-        evs.sort(key = lambda x: x["timestamp"])
+        evs = users[usr] # sorted by timestamp when loaded
 
         # get features and labels from borrow events
-        for ev in evs:
-            if ev["event_type"] != "borrow": continue
-            feats = get_features_and_label(evs, ev["timestamp"])
+        for event_type, timestamp in zip(evs.columns["event_type"], evs.columns["timestamp"]):
+            if event_type != "borrow": continue
+            feats = get_features_and_label(evs, timestamp)
 
     print(f"\nfeatures extracted for all users successfully.\n")
     print(f"\nfeature column example:\n{feats}")
@@ -5,10 +5,18 @@ import random
 import pandas as pd
 import numpy as np
 import importlib
+import scipy.sparse
 from sklearn.metrics import roc_auc_score
 
 # same as "from 01-feature-engineering import get_features_and_label"
 get_features_and_label = importlib.import_module('01-feature-engineering').get_features_and_label
+ReserveFeatures = importlib.import_module('01-feature-engineering').ReserveFeatures
+
+# same as "from event-store import load_user_mapping"
+load_user_mapping = importlib.import_module('event-store').load_user_mapping
+
+# same as "from model-params import MODEL_PARAMS"
+MODEL_PARAMS = importlib.import_module('model-params').MODEL_PARAMS
 
 
 if __name__ == "__main__":
@@ -17,8 +25,7 @@ if __name__ == "__main__":
     data_file = os.getcwd() + '/data/all_user_mapping.json'
     if os.path.isfile(data_file):
         print("\"all_user_mapping.json\" found, loading from disk.")
-        with open("./data/all_user_mapping.json") as f:
-            users = json.load(f)
+        users = load_user_mapping("./data/all_user_mapping.json")
     elif os.path.isfile(data_file) == False:
         raise FileNotFoundError("User mapping file \"all_user_mapping.json\" not present in data directory. Try running `graphql_fetcher.py` to retrieve and store the data.")
 
@@ -29,27 +36,35 @@ if __name__ == "__main__":
     Dtest = {}
     train_frac = 0.66 # 2/3 of data used to train
 
+    # sparse per reserve / per asset features, the test set shares the training columns
+    use_reserve_features = True
+    Rtrain = ReserveFeatures()
+    Rtest = ReserveFeatures(Rtrain.columns)
+
     random.seed(1234)
     for usr in users:
-        evs = users[usr]
-        evs.sort(key = lambda x: x["timestamp"])
+        evs = users[usr] # sorted by timestamp when loaded
 
         # train / test split, randomly assign users to either train or test groups 
                                 # D points to Dtrain or Dtest depending on split
         if random.uniform(0,1) < train_frac:
-            D = Dtrain
+            D, R = Dtrain, Rtrain
         else:
-            D = Dtest
+            D, R = Dtest, Rtest
 
-        for ev in evs:
-            if ev["event_type"] != "borrow": continue
+        # read the two columns the loop needs, rather than decoding whole events
+        for event_type, timestamp in zip(evs.columns["event_type"], evs.columns["timestamp"]):
+            if event_type != "borrow": continue
 
             # append lists of features to each key column from every event
              # D {
                 # label: [{event1} {event2}],
                 # feat1: [{event1}, {event1}]
              # }
-            feats = get_features_and_label(evs, ev["timestamp"])
+            feats = get_features_and_label(evs, timestamp, per_reserve=use_reserve_features)
+            if use_reserve_features:
+                feats, reserve_feats = feats
+                R.add_row(reserve_feats)
             for fk in feats:
                 if fk not in D: D[fk] = [] # set default as a list
                 D[fk].append(float(feats[fk])) # update dict with list of values from each event
@@ -64,27 +79,21 @@ if __name__ == "__main__":
     df_tr.drop(["label"],inplace=True,axis=1)
     df_te.drop(["label"],inplace=True,axis=1)
 
-    TR = lightgbm.Dataset(df_tr,label=target_tr)
-    TE = lightgbm.Dataset(df_te,label=target_te)
-
-    MD = 3 # max depth for the treess
-    NE = 200 # number of trees in the gradient boosting model
-    TD = 2.0 # total distance searched by the gradient boosting iteration
-
-    params = {
-        "n_estimators" : NE,
-        'boosting_type': 'gbdt',
-        'objective': 'binary',
-        'num_leaves': int(2**MD),
-        'learning_rate': TD/NE,
-        'feature_fraction': 1.0,
-        'bagging_fraction': 1.0,
-        'verbose': 0,
-        'max_depth': MD
-    }
+    # append the sparse reserve features to the dense ones, lightgbm takes the CSR matrix as is
+    if use_reserve_features:
+        X_tr = scipy.sparse.hstack([scipy.sparse.csr_matrix(df_tr.values), Rtrain.to_csr()], format="csr")
+        X_te = scipy.sparse.hstack([scipy.sparse.csr_matrix(df_te.values), Rtest.to_csr()], format="csr")
+        feature_name = list(df_tr.columns) + Rtrain.feature_names(users.table)
+    else:
+        X_tr, X_te, feature_name = df_tr, df_te, "auto"
+
+    TR = lightgbm.Dataset(X_tr,label=target_tr,feature_name=feature_name)
+    TE = lightgbm.Dataset(X_te,label=target_te,feature_name=feature_name)
+
+    params = MODEL_PARAMS # same params as 03, but a random rather than out of time split
 
     model = lightgbm.train(params, TR)
-    preds = model.predict(df_te)
+    preds = model.predict(X_te)
 
     print(roc_auc_score(target_te,preds))
 
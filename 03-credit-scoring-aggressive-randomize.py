@@ -4,13 +4,20 @@ import lightgbm
 import random
 import pandas as pd
 import numpy as np
-import datetime
-import time
 import importlib
+import scipy.sparse
 from sklearn.metrics import roc_auc_score
 
 # same as "from 01-feature-engineering import get_features_and_label"
 get_features_and_label = importlib.import_module('01-feature-engineering').get_features_and_label
+ReserveFeatures = importlib.import_module('01-feature-engineering').ReserveFeatures
+
+# same as "from event-store import load_user_mapping"
+load_user_mapping = importlib.import_module('event-store').load_user_mapping
+
+# same as "from model-params import MODEL_PARAMS, SPLIT_PARAMS", shared with run-pipeline.py
+MODEL_PARAMS = importlib.import_module('model-params').MODEL_PARAMS
+SPLIT_PARAMS = importlib.import_module('model-params').SPLIT_PARAMS
 
 if __name__ == "__main__":
     
@@ -18,8 +25,7 @@ if __name__ == "__main__":
     data_file = os.getcwd() + '/data/all_user_mapping.json'
     if os.path.isfile(data_file):
         print("\"all_user_mapping.json\" found, loading from disk.")
-        with open("./data/all_user_mapping.json") as f:
-            users = json.load(f)
+        users = load_user_mapping("./data/all_user_mapping.json")
     elif os.path.isfile(data_file) == False:
         raise FileNotFoundError("User mapping file \"all_user_mapping.json\" not present in data directory. Try running `graphql_fetcher.py` to retrieve and store the data.")
 
@@ -29,45 +35,50 @@ if __name__ == "__main__":
 
     Dtrain = {}
     Dtest = {}
-    train_frac = 0.66 # 2/3 of data used to train
+    train_frac = SPLIT_PARAMS["train_frac"] # 2/3 of data used to train
 
-    # relevant cutoff dates
-    APR_15_2021 = time.mktime(datetime.datetime(2021,4,15).timetuple())
-    JAN_1_2021 = time.mktime(datetime.datetime(2021,1,1).timetuple())
+    # sparse per reserve / per asset features, the test set shares the training columns
+    use_reserve_features = True
+    Rtrain = ReserveFeatures()
+    Rtest = ReserveFeatures(Rtrain.columns)
 
-    # set this to True for the more aggressive test
-    out_of_time_test = True
+    # relevant cutoff dates
+    APR_15_2021 = SPLIT_PARAMS["apr_15_2021"]
+    JAN_1_2021 = SPLIT_PARAMS["jan_1_2021"]
 
-    # set this to enforce at least 3 months of future data, this eliminates
-    # another possible "cheat"
-    enforce_3months_future = True
+    # set these in model-params.py, see the comments there
+    out_of_time_test = SPLIT_PARAMS["out_of_time_test"]
+    enforce_3months_future = SPLIT_PARAMS["enforce_3months_future"]
 
-    random.seed(1234)
+    random.seed(SPLIT_PARAMS["seed"])
     for u in users:
-        evs = users[u]
-        evs.sort(key = lambda x: x["timestamp"])
+        evs = users[u] # sorted by timestamp when loaded
 
         # train / test split, randomly assign users to either train or test groups
                                 # D points to Dtrain or Dtest depending on split
-        if random.uniform(0,1) < train_frac: D = Dtrain
-        else: D = Dtest
+        if random.uniform(0,1) < train_frac: D, R = Dtrain, Rtrain
+        else: D, R = Dtest, Rtest
 
-        for ev in evs:
-            if ev["event_type"] != "borrow": continue
+        # read the two columns the loop needs, rather than decoding whole events
+        for event_type, timestamp in zip(evs.columns["event_type"], evs.columns["timestamp"]):
+            if event_type != "borrow": continue
 
             # don't try to model if there isn't 3 months of future data
-            if enforce_3months_future and ev["timestamp"] > APR_15_2021: continue
+            if enforce_3months_future and timestamp > APR_15_2021: continue
 
             if out_of_time_test: # train and test on different years.
-                if D == Dtrain and ev["timestamp"] > JAN_1_2021: continue
-                if D == Dtest and ev["timestamp"] < JAN_1_2021: continue
+                if D is Dtrain and timestamp > JAN_1_2021: continue
+                if D is Dtest and timestamp < JAN_1_2021: continue
 
             # append lists of features to each key column from every event
             # D {
                 # label: [{event1} {event2}],
                 # feat1: [{event1}, {event1}]
             # }
-            feats = get_features_and_label(evs, ev["timestamp"])
+            feats = get_features_and_label(evs, timestamp, per_reserve=use_reserve_features)
+            if use_reserve_features:
+                feats, reserve_feats = feats
+                R.add_row(reserve_feats)
             for fk in feats:
                 if fk not in D: D[fk] = [] # set default as a list
                 D[fk].append(float(feats[fk])) # update dict with list of values from each event
@@ -82,27 +93,26 @@ if __name__ == "__main__":
     df_tr.drop(["label"],inplace=True,axis=1)
     df_te.drop(["label"],inplace=True,axis=1)
 
-    TR = lightgbm.Dataset(df_tr,label=target_tr)
-    TE = lightgbm.Dataset(df_te,label=target_te)
-
-    MD = 3 # max depth for the treess
-    NE = 200 # number of trees in the gradient boosting model
-    TD = 2.0 # total distance searched by the gradient boosting iteration
-
-    params = {
-        "n_estimators" : NE,
-        'boosting_type': 'gbdt',
-        'objective': 'binary',
-        'num_leaves': int(2**MD),
-        'learning_rate': TD/NE,
-        'feature_fraction': 1.0,
-        'bagging_fraction': 1.0,
-        'verbose': 0,
-        'max_depth': MD
-    }
+    # append the sparse reserve features to the dense ones, lightgbm takes the CSR matrix as is
+    if use_reserve_features:
+        X_tr = scipy.sparse.hstack([scipy.sparse.csr_matrix(df_tr.values), Rtrain.to_csr()], format="csr")
+        X_te = scipy.sparse.hstack([scipy.sparse.csr_matrix(df_te.values), Rtest.to_csr()], format="csr")
+        feature_name = list(df_tr.columns) + Rtrain.feature_names(users.table)
+    else:
+        X_tr, X_te, feature_name = df_tr, df_te, "auto"
+
+    TR = lightgbm.Dataset(X_tr,label=target_tr,feature_name=feature_name)
+    TE = lightgbm.Dataset(X_te,label=target_te,feature_name=feature_name)
+
+    params = MODEL_PARAMS
 
     model = lightgbm.train(params, TR)
-    preds = model.predict(df_te)
+    preds = model.predict(X_te)
 
     print(roc_auc_score(target_te,preds))
 
+    # save the model and its reserve column layout for bulk scoring (05-bulk-scoring.py)
+    model.save_model("./data/model.txt")
+    with open("./data/reserve_columns.json", "wt") as f:
+        json.dump(Rtrain.column_keys(users.table) if use_reserve_features else [], f, indent=2)
+
@@ -7,19 +7,51 @@ import numpy as np
 import datetime
 import time
 import importlib
+from multiprocessing import Pool
 from sklearn.metrics import roc_auc_score
 
 # same as "from 01-feature-engineering import get_features_and_label"
 get_features_and_label = importlib.import_module('01-feature-engineering').get_features_and_label
 
+# same as "from event-store import load_user_mapping"
+load_user_mapping = importlib.import_module('event-store').load_user_mapping
+
+# same as "from model-params import MODEL_PARAMS"
+MODEL_PARAMS = importlib.import_module('model-params').MODEL_PARAMS
+
+# same as "from shared-data import SharedDataset, attach_frame, attach_array"
+shared_data = importlib.import_module('shared-data')
+
+
+def retrain_without_feature(args):
+    """
+        retrain with one feature hidden and score on the test set, runs in a worker process.
+
+        the train / test data are attached from shared memory rather than
+        pickled into every worker. Zeroing a column makes it constant, so
+        lightgbm never splits on it, a zero feature_contri gives the same
+        model without a modified copy of the training data.
+    """
+    fk, specs, params = args
+
+    df_tr = shared_data.attach_frame(specs["train"])
+    df_te = shared_data.attach_frame(specs["test"])
+    target_tr = shared_data.attach_array(specs["target_train"])
+    target_te = shared_data.attach_array(specs["target_test"])
+
+    params = dict(params, feature_contri=[0.0 if col == fk else 1.0 for col in df_tr.columns])
+    model = lightgbm.train(params, lightgbm.Dataset(df_tr, label=target_tr))
+    preds = model.predict(df_te)
+    return fk, roc_auc_score(target_te, preds)
+
+
 if __name__ == "__main__":
     
     print("checking for user mapping on disk ...")
     data_file = os.getcwd() + '/data/all_user_mapping.json'
     if os.path.isfile(data_file):
         print("\"all_user_mapping.json\" found, loading from disk.")
-        with open("./data/all_user_mapping.json") as f:
-            users = json.load(f)
+        users = load_user_mapping("./data/all_user_mapping.json")
     elif os.path.isfile(data_file) == False:
         raise FileNotFoundError("User mapping file \"all_user_mapping.json\" not present in data directory. Try running `graphql_fetcher.py` to retrieve and store the data.")
 
@@ -44,16 +76,16 @@ if __name__ == "__main__":
 
     random.seed(1234)
     for u in users:
-        evs = users[u]
-        evs.sort(key = lambda x: x["timestamp"])
+        evs = users[u] # sorted by timestamp when loaded
 
         if random.uniform(0,1) < train_frac: D = Dtrain
         else: D = Dtest
 
-        for ev in evs:
-            if ev["event_type"] != "borrow": continue
+        # read the two columns the loop needs, rather than decoding whole events
+        for event_type, timestamp in zip(evs.columns["event_type"], evs.columns["timestamp"]):
+            if event_type != "borrow": continue
 
-            feats = get_features_and_label(evs, ev["timestamp"])
+            feats = get_features_and_label(evs, timestamp)
             for fk in feats:
                 if fk not in D: D[fk] = []
                 D[fk].append(float(feats[fk]))
@@ -72,21 +104,7 @@ if __name__ == "__main__":
     TR = lightgbm.Dataset(df_tr,label=target_tr)
     TE = lightgbm.Dataset(df_te,label=target_te)
 
-    MD = 3 # max depth for the treess
-    NE = 200 # number of trees in the gradient boosting model
-    TD = 2.0 # total distance searched by the gradient boosting iteration
-
-    params = {
-        "n_estimators" : NE,
-        'boosting_type': 'gbdt',
-        'objective': 'binary',
-        'num_leaves': int(2**MD),
-        'learning_rate': TD/NE,
-        'feature_fraction': 1.0,
-        'bagging_fraction': 1.0,
-        'verbose': 0,
-        'max_depth': MD
-    }
+    params = MODEL_PARAMS # same params as 03, but no reserve features and a random split, so not 03's model
 
     # we're going to iterate over the keys, deleting one at a time
     # to check impact on AUC
@@ -99,21 +117,23 @@ if __name__ == "__main__":
 
     print(f"roc auc score {orig_roc}")
 
-    # need an original copy of the training data since we're going
-    # to be zeroing out columns
-    df_tr_orig = df_tr.copy(deep=True)
-
+    # share the train / test data once, each worker attaches to it by name
+    # and trains with a single thread so the workers don't oversubscribe cores
     importance = {}
-
-    for fk in feat_keys:
-        df_tr_curr = df_tr_orig.copy(deep=True)
-        df_tr_curr[fk] = df_tr_curr[fk]*0.0 # act as if we didn't have this feature
-        TR = lightgbm.Dataset(df_tr_curr,label=target_tr)
-        model = lightgbm.train(params, TR)
-        preds = model.predict(df_te)
-        curr_roc = roc_auc_score(target_te,preds)
-        importance[fk] = orig_roc - curr_roc
-        with open("/data/importance.json","wt") as f: 
-            json.dump(importance, f, sort_keys=True,indent=2)
-        print(fk, orig_roc - curr_roc)
-
+    worker_params = dict(params, num_threads=1)
+
+    with shared_data.SharedDataset() as ds:
+        specs = {
+            "train": ds.share_frame(df_tr),
+            "test": ds.share_frame(df_te),
+            "target_train": ds.share_array(target_tr),
+            "target_test": ds.share_array(target_te),
+        }
+
+        with Pool() as pool:
+            tasks = [(fk, specs, worker_params) for fk in feat_keys]
+            for fk, curr_roc in pool.imap_unordered(retrain_without_feature, tasks):
+                importance[fk] = orig_roc - curr_roc
+                with open("./data/importance.json","wt") as f: 
+                    json.dump(importance, f, sort_keys=True,indent=2)
+                print(fk, orig_roc - curr_roc)
@@ -0,0 +1,195 @@
+import os
+import sys
+import csv
+import json
+import time
+import lightgbm
+import numpy as np
+import importlib
+import scipy.sparse
+from multiprocessing import Pool
+
+# same as "from 01-feature-engineering import get_features_and_label, ReserveFeatures"
+get_features_and_label = importlib.import_module('01-feature-engineering').get_features_and_label
+ReserveFeatures = importlib.import_module('01-feature-engineering').ReserveFeatures
+
+# same as "from shared-data import SharedDataset, attach_events"
+shared_data = importlib.import_module('shared-data')
+
+
+# per worker state, set once by init_worker instead of being sent with every chunk
+_worker = {}
+
+
+def init_worker(model_file, events_spec, dense_names, reserve_columns, as_of, explain):
+    """
+        load the model and attach to the shared event store, once per worker process.
+    """
+    _worker["model"] = lightgbm.Booster(model_file=model_file)
+    _worker["contrib_names"] = _worker["model"].feature_name() + ["bias"]
+    _worker["explain"] = explain
+    _worker["store"] = shared_data.attach_events(events_spec)
+    _worker["dense_names"] = dense_names
+    _worker["reserve_columns"] = reserve_columns
+    _worker["as_of"] = as_of
+
+
+def score_chunk(bounds):
+    """
+        score the users in [start, stop) of the event store as of `as_of`.
+
+        features are the same trailing window features used in training,
+        taken at `as_of` instead of at a borrow event.
+
+        with `explain` set, the scores come from the model's TreeSHAP feature
+        contributions (pred_contrib) for the whole chunk, so explaining costs
+        one batched prediction rather than a retrain per feature. Returns
+        (rows, explanations, abs_contrib_sum), the last two are None otherwise.
+    """
+    start, stop = bounds
+    dense_names = _worker["dense_names"]
+    reserve_columns = _worker["reserve_columns"]
+
+    user_ids = []
+    dense = []
+    R = ReserveFeatures(reserve_columns, grow=False)
+
+    for usr, evs in _worker["store"].items(start, stop):
+        feats, reserve_feats = get_features_and_label(evs, _worker["as_of"], per_reserve=True)
+        user_ids.append(usr)
+        dense.append([float(feats[fk]) for fk in dense_names])
+        R.add_row(reserve_feats)
+
+    X = np.array(dense, dtype=np.float64)
+    if reserve_columns:
+        X = scipy.sparse.hstack([scipy.sparse.csr_matrix(X), R.to_csr()], format="csr")
+
+    # one thread per worker, the pool already uses every core
+    if not _worker["explain"]:
+        scores = _worker["model"].predict(X, num_threads=1)
+        return list(zip(user_ids, scores.tolist())), None, None
+
+    # one column per feature plus the bias, each row sums to the raw (log odds) score
+    contrib = _worker["model"].predict(X, pred_contrib=True, num_threads=1)
+    contrib = scipy.sparse.csr_matrix(contrib)
+    raw_scores = np.asarray(contrib.sum(axis=1)).ravel()
+    scores = 1.0 / (1.0 + np.exp(-raw_scores))
+
+    # keep the non zero contributions per user, most users touch a few reserves
+    contrib_names = _worker["contrib_names"]
+    explanations = []
+    for i in range(contrib.shape[0]):
+        row = slice(contrib.indptr[i], contrib.indptr[i + 1])
+        explanations.append({
+            contrib_names[j]: value
+            for j, value in zip(contrib.indices[row].tolist(), contrib.data[row].tolist())
+        })
+
+    abs_contrib_sum = np.asarray(abs(contrib).sum(axis=0)).ravel()
+    return list(zip(user_ids, scores.tolist())), explanations, abs_contrib_sum
+
+
+def get_reserve_columns(column_keys, codes):
+    """
+        map the saved reserve column layout onto the codes of the loaded events,
+        `codes` as returned by EventStore.codes().
+
+        ids that don't appear in the loaded events keep their column under the
+        raw id, no event key matches it but the matrix keeps its width.
+    """
+    return {
+        (kind, codes.get(key, key), stat): idx
+        for idx, (kind, key, stat) in enumerate(column_keys)
+    }
+
+
+def run_bulk_scoring(model_file, user_mapping_file, out_file, as_of, chunk_size=1000, processes=None, explain_file=None, importance_file=None):
+    """
+        score every user as of `as_of` and write (user_id, score, as_of) rows to a csv file.
+
+        the user mapping is streamed straight into a columnar event store in
+        shared memory, it's never loaded as a whole. Workers attach to the
+        store and build features for one chunk of users at a time, and
+        results are written as chunks finish. Memory is the shared store (one
+        copy for every process), the table of distinct ids and a chunk per
+        worker.
+
+        with `explain_file` set, each user's non zero feature contributions
+        are written there as json lines:
+            {"user_id": , "as_of": , "contributions": {feature: log odds, ..., "bias": }}
+        and the mean absolute contribution of each feature over all users,
+        a global importance without retraining, goes to `importance_file`.
+    """
+    feature_names = lightgbm.Booster(model_file=model_file).feature_name()
+    explain = explain_file is not None
+
+    column_keys = []
+    columns_file = os.path.join(os.path.dirname(model_file), "reserve_columns.json")
+    if os.path.isfile(columns_file):
+        with open(columns_file) as f:
+            column_keys = json.load(f)
+
+    # the model's dense features come first, then the reserve columns
+    dense_names = feature_names[:len(feature_names) - len(column_keys)]
+
+    with shared_data.SharedDataset() as ds:
+        # only the id codes are needed here, workers attach their own view.
+        # the owner side store must go before the segments are closed
+        users, events_spec = ds.load_events(user_mapping_file)
+        reserve_columns = get_reserve_columns(column_keys, users.codes())
+        num_users = len(users)
+        del users
+
+        chunks = [(start, min(start + chunk_size, num_users)) for start in range(0, num_users, chunk_size)]
+        initargs = (model_file, events_spec, dense_names, reserve_columns, as_of, explain)
+
+        num_scored = 0
+        abs_contrib_total = np.zeros(len(feature_names) + 1)
+        with Pool(processes, initializer=init_worker, initargs=initargs) as pool, open(out_file, "wt", newline="") as f, \
+                open(explain_file if explain else os.devnull, "wt") as explain_f:
+            writer = csv.writer(f)
+            writer.writerow(["user_id", "score", "as_of"])
+
+            for rows, explanations, abs_contrib_sum in pool.imap_unordered(score_chunk, chunks):
+                writer.writerows((usr, score, as_of) for usr, score in rows)
+                num_scored += len(rows)
+
+                if explain:
+                    for (usr, _), contributions in zip(rows, explanations):
+                        explain_f.write(json.dumps({"user_id": usr, "as_of": as_of, "contributions": contributions}) + "\n")
+                    abs_contrib_total += abs_contrib_sum
+
+                print(f"scored {num_scored}/{num_users} users")
+
+    if explain and importance_file is not None:
+        importance = dict(zip(feature_names, (abs_contrib_total[:-1] / max(1, num_scored)).tolist()))
+        with open(importance_file, "wt") as f:
+            json.dump(importance, f, sort_keys=True, indent=2)
+
+    return num_scored
+
+
+if __name__ == "__main__":
+
+    # usage: python 05-bulk-scoring.py [as_of unix timestamp, defaults to now] [--explain]
+    args = [arg for arg in sys.argv[1:] if arg != "--explain"]
+    as_of = int(args[0]) if args else int(time.time())
+    explain = "--explain" in sys.argv
+
+    print("checking for model and user mapping on disk ...")
+    model_file = os.getcwd() + '/data/model.txt'
+    data_file = os.getcwd() + '/data/all_user_mapping.json'
+    if os.path.isfile(model_file) == False:
+        raise FileNotFoundError("Model file \"model.txt\" not present in data directory. Try running `03-credit-scoring-aggressive-randomize.py` to train and save the model.")
+    if os.path.isfile(data_file) == False:
+        raise FileNotFoundError("User mapping file \"all_user_mapping.json\" not present in data directory. Try running `graphql_fetcher.py` to retrieve and store the data.")
+
+    print(f"scoring all users as of {as_of} ...")
+    num_scored = run_bulk_scoring(
+        "./data/model.txt", "./data/all_user_mapping.json", "./data/scores.csv", as_of,
+        explain_file="./data/explanations.jsonl" if explain else None,
+        importance_file="./data/shap_importance.json" if explain else None,
+    )
+    print(f"{num_scored} users scored, saved to ./data/scores.csv")
+    if explain:
+        print("feature contributions saved to ./data/explanations.jsonl, global importance to ./data/shap_importance.json")
@@ -0,0 +1,51 @@
+import sys
+import os
+import json
+import importlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# same as "from graphql-fetcher import get_cache_key, get_cache_path, CACHE_DIR"
+fetcher = importlib.import_module('graphql-fetcher')
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    """
+        Answer graphql POSTs with the raw response pages in the response cache.
+
+        pages are sent as stored (gzipped), so serving is bound by disk reads.
+        queries that were never recorded get a graphql style error response.
+    """
+
+    cache_dir = fetcher.CACHE_DIR
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        path = fetcher.get_cache_path(fetcher.get_cache_key(payload), self.cache_dir)
+
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('content-encoding', 'gzip')
+        else:
+            body = json.dumps({"errors": [{"message": "query not in response cache"}]}).encode()
+            self.send_response(200)
+
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the terminal quiet, a fetch sends thousands of requests
+        pass
+
+
+if __name__ == "__main__":
+
+    # usage: python cache-server.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), CacheHandler)
+    print(f"serving cached responses from {CacheHandler.cache_dir} at http://127.0.0.1:{port}/")
+    server.serve_forever()
@@ -0,0 +1,444 @@
+import re
+import sys
+import json
+
+import numpy as np
+
+
+# hex ids and other repeated strings, stored as int32 codes into the store's string table
+ID_FIELDS = (
+    "user_id",
+    "pool_id",
+    "pool_lendingPool",
+    "reserve_id",
+    "reserve_symbol",
+    "borrowRateMode",
+    "liquidator",
+    "collateralReserve_id",
+    "collateralReserve_underlyingAsset",
+    "principalReserve_id",
+    "principalReserve_underlyingAsset",
+)
+
+# amounts, parsed once at load and split into high / low uint64 halves so they stay exact
+INT_FIELDS = (
+    "amount",
+    "amountAfterFee",
+    "fee",
+    "borrowRate",
+    "accruedBorrowInterest",
+    "collateralAmount",
+    "principalAmount",
+)
+
+# txn_id is kept as a string, event_type is a code into the string table like the ids
+STR_FIELDS = ("txn_id", "event_type")
+
+# every field gets a bit in the per event presence mask, in this order
+FIELDS = ("timestamp",) + ID_FIELDS + INT_FIELDS + STR_FIELDS
+
+_ID_FIELDS = frozenset(ID_FIELDS)
+_INT_FIELDS = frozenset(INT_FIELDS)
+_BITS = {key: 1 << bit for bit, key in enumerate(FIELDS)}
+
+# the INT_FIELDS bits are contiguous, (mask >> _INT_SHIFT) & _INT_MASK has one bit per amount,
+# and _POPCOUNT counts how many amounts an event has before a given one
+_INT_SHIFT = FIELDS.index(INT_FIELDS[0])
+_INT_MASK = (1 << len(INT_FIELDS)) - 1
+_POPCOUNT = [bin(bits).count("1") for bits in range(1 << len(INT_FIELDS))]
+
+_LOW_MASK = (1 << 64) - 1
+_WHITESPACE = re.compile(r"\s*")
+
+# unsupported fields already warned about, once per field rather than per event
+_UNSUPPORTED = set()
+
+
+def _warn_unsupported(key):
+    if key not in _UNSUPPORTED:
+        _UNSUPPORTED.add(key)
+        print(f"skipping unsupported event field \"{key}\", it isn't in event-store.py's field lists")
+
+
+class StringColumn:
+    """
+        read only list of strings stored as one utf-8 blob and offsets into it, decoded on access.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class EventStore:
+    """
+        Columnar user mapping, one numpy array per event field.
+
+        events are grouped by user and sorted by timestamp, `offsets` holds
+        each user's slice of the columns. Ids and event types are int32
+        codes into `table` (-1 when an event doesn't have the field), and
+        `presence` has a bit per field in FIELDS.
+
+        Events only have a few of the INT_FIELDS, so amounts are stored
+        sparsely: the ones each event has, in INT_FIELDS order, split into
+        high / low uint64 columns so 128-bit values stay exact.
+        `amounts.offsets` holds each user's slice of them.
+
+        All state is in `columns`, so the store can be built straight into
+        shared memory and attached by other processes (see shared-data.py).
+
+        It reads like the dict mapping it was loaded from:
+            store[user_id] -> UserEvents
+            for user_id in store: ...
+            store.items(start, stop) -> (user_id, UserEvents), e.g. a worker's chunk
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.offsets = columns["offsets"]
+        self.user_ids = StringColumn(columns["user_ids.blob"], columns["user_ids.offsets"])
+        self.table = StringColumn(columns["strings.blob"], columns["strings.offsets"])
+        self.txn_ids = StringColumn(columns["txn_ids.blob"], columns["txn_ids.offsets"])
+        self._index = None
+        self._strings = {}
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __getitem__(self, user_id):
+        if self._index is None:
+            self._index = {usr: i for i, usr in enumerate(self.user_ids)}
+        return self.user_events(self._index[user_id])
+
+    def user_events(self, i):
+        """
+            events of the i-th user, in the order users were loaded.
+        """
+        return UserEvents(self, i)
+
+    def items(self, start=0, stop=None):
+        """
+            (user_id, events) for users in [start, stop).
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            yield self.user_ids[i], self.user_events(i)
+
+    def decode(self, code):
+        """
+            string for a table code, decoded and interned once.
+        """
+        string = self._strings.get(code)
+        if string is None:
+            string = self._strings[code] = sys.intern(self.table[code])
+        return string
+
+    def codes(self):
+        """
+            {string: code} for every string in the table.
+        """
+        return {string: code for code, string in enumerate(self.table)}
+
+    def get_column(self, key, i):
+        """
+            values of one field for the i-th user's events as a list, None
+            where an event doesn't have the field. Ids are left as codes.
+        """
+        start, stop = int(self.offsets[i]), int(self.offsets[i + 1])
+
+        if key == "timestamp":
+            return self.columns["timestamp"][start:stop].tolist()
+
+        if key == "event_type":
+            return [None if code < 0 else self.decode(code) for code in self.columns["event_type"][start:stop].tolist()]
+
+        if key in _ID_FIELDS:
+            return [None if code < 0 else code for code in self.columns[key][start:stop].tolist()]
+
+        if key not in _BITS:
+            raise KeyError(key)
+
+        masks = self.columns["presence"][start:stop].tolist()
+        if key == "txn_id":
+            bit = _BITS[key]
+            return [self.txn_ids[start + j] if mask & bit else None for j, mask in enumerate(masks)]
+
+        amount_start, amount_stop = int(self.columns["amounts.offsets"][i]), int(self.columns["amounts.offsets"][i + 1])
+        highs = self.columns["amounts.high"][amount_start:amount_stop].tolist()
+        lows = self.columns["amounts.low"][amount_start:amount_stop].tolist()
+
+        # an event's amount for this field comes after the ones it has for earlier fields
+        bit = _BITS[key] >> _INT_SHIFT
+        earlier = bit - 1
+        values = []
+        pos = 0
+        for mask in masks:
+            bits = mask >> _INT_SHIFT & _INT_MASK
+            if bits & bit:
+                k = pos + _POPCOUNT[bits & earlier]
+                values.append(highs[k] << 64 | lows[k])
+            else:
+                values.append(None)
+            pos += _POPCOUNT[bits]
+        return values
+
+
+class _LazyColumns(dict):
+    """
+        a user's columns, each one built from the store the first time it's used.
+    """
+
+    def __init__(self, events):
+        super().__init__()
+        self._events = events
+
+    def __missing__(self, key):
+        events = self._events
+        column = self[key] = events.store.get_column(key, events.index)
+        return column
+
+
+class UserEvents:
+    """
+        One user's events, a view into an EventStore.
+
+        `columns[field]` is that field's values as a python list, built the
+        first time it's asked for: ids as codes, amounts as ints and None
+        where an event doesn't have the field. Events are sorted by timestamp,
+        so get_features_and_label finds its windows by bisection.
+
+        Iterating gives the events as dicts, like graphql-fetcher writes them.
+    """
+
+    def __init__(self, store, i):
+        self.store = store
+        self.index = i
+        self.columns = _LazyColumns(self)
+
+    def __len__(self):
+        return int(self.store.offsets[self.index + 1] - self.store.offsets[self.index])
+
+    def __iter__(self):
+        # built from the cached columns, which the feature code reuses
+        decode = self.store.decode
+        columns = [(key, self.columns[key]) for key in FIELDS]
+        for j in range(len(self)):
+            event = {}
+            for key, values in columns:
+                value = values[j]
+                if value is None:
+                    continue
+                if key in _ID_FIELDS:
+                    value = decode(value)
+                elif key in _INT_FIELDS:
+                    value = str(value)
+                event[key] = value
+            yield event
+
+
+def iter_user_mapping(path, chunk_size=1 << 20):
+    """
+        stream (user_id, events) from a user mapping file, one user at a time.
+
+        json.load would build the event dicts of every user at once, this
+        only holds one user's events and a read buffer.
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path) as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def read_more():
+            # drop what's been parsed, read at least as much as is left so retries stay linear
+            nonlocal buf, pos, eof
+            chunk = f.read(max(chunk_size, len(buf) - pos))
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def peek():
+            # next non whitespace character, without consuming it
+            nonlocal pos
+            while True:
+                pos = _WHITESPACE.match(buf, pos).end()
+                if pos < len(buf):
+                    return buf[pos]
+                if eof:
+                    raise ValueError(f"unexpected end of user mapping file: {path}")
+                read_more()
+
+        def decode():
+            # keys are strings and values are lists, neither parses until it's complete
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    value, pos = decoder.raw_decode(buf, pos)
+                    return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    read_more()
+
+        if peek() != "{":
+            raise ValueError(f"user mapping file should hold a json object: {path}")
+        pos += 1
+        if peek() == "}":
+            return
+
+        while True:
+            user_id = decode()
+            if peek() != ":":
+                raise ValueError(f"malformed user mapping file: {path}")
+            pos += 1
+            yield user_id, decode()
+
+            separator = peek()
+            pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"malformed user mapping file: {path}")
+
+
+def _allocate(name, shape, dtype):
+    return np.empty(shape, dtype=dtype)
+
+
+def load_user_mapping(path, allocate=_allocate):
+    """
+        load a user mapping file ("all_user_mapping.json") into a columnar EventStore.
+
+        the file is streamed twice, one user at a time: the first pass sizes
+        the columns and the second fills them, so every column is allocated
+        once and the whole mapping is never held as dicts.
+        `allocate(name, shape, dtype)` returns the array for each column,
+        e.g. a view into shared memory.
+
+        null fields are treated as missing.
+    """
+    num_users = num_events = num_amounts = user_bytes = txn_bytes = 0
+    for usr, evs in iter_user_mapping(path):
+        num_users += 1
+        num_events += len(evs)
+        user_bytes += len(usr.encode())
+        for e in evs:
+            num_amounts += sum(e[key] is not None for key in _INT_FIELDS.intersection(e))
+            if e.get("txn_id") is not None:
+                txn_bytes += len(e["txn_id"].encode())
+
+    columns = {}
+
+    def column(name, shape, dtype, fill=None):
+        array = columns[name] = allocate(name, shape, dtype)
+        if fill is not None:
+            array[...] = fill
+        return array
+
+    offsets = column("offsets", num_users + 1, np.int64, 0)
+    user_blob = column("user_ids.blob", user_bytes, np.uint8)
+    user_offsets = column("user_ids.offsets", num_users + 1, np.int64, 0)
+    timestamps = column("timestamp", num_events, np.int64, 0)
+    presence = column("presence", num_events, np.uint32, 0)
+    event_types = column("event_type", num_events, np.int32, -1)
+    txn_blob = column("txn_ids.blob", txn_bytes, np.uint8)
+    txn_offsets = column("txn_ids.offsets", num_events + 1, np.int64, 0)
+    codes = {key: column(key, num_events, np.int32, -1) for key in ID_FIELDS}
+    amount_offsets = column("amounts.offsets", num_users + 1, np.int64, 0)
+    highs = column("amounts.high", num_amounts, np.uint64)
+    lows = column("amounts.low", num_amounts, np.uint64)
+
+    # ids and event types are both codes into one table of distinct strings,
+    # the only thing besides the columns that grows with the data
+    code_columns = dict(codes, event_type=event_types)
+    table = {}
+
+    start = user_start = txn_start = amount_pos = 0
+    for i, (usr, evs) in enumerate(iter_user_mapping(path)):
+        evs.sort(key = lambda x: x["timestamp"])
+        stop = start + len(evs)
+
+        encoded = usr.encode()
+        user_blob[user_start:user_start + len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+        user_start += len(encoded)
+        user_offsets[i + 1] = user_start
+        offsets[i + 1] = stop
+
+        # collected per user and written with one slice per column, numpy is slow at single items
+        n = len(evs)
+        user_codes = {key: [-1] * n for key in code_columns}
+        user_timestamps = [0] * n
+        masks = [0] * n
+        amounts = []
+
+        for j, e in enumerate(evs):
+            mask = 0
+            event_amounts = []
+            for key, value in e.items():
+                bit = _BITS.get(key)
+                if bit is None:
+                    _warn_unsupported(key)
+                    continue
+                if value is None:
+                    continue
+                mask |= bit
+
+                if key in user_codes:
+                    c = table.get(value)
+                    if c is None:
+                        c = table[value] = len(table)
+                    user_codes[key][j] = c
+                elif key in _INT_FIELDS:
+                    value = int(value)
+                    if not 0 <= value < 1 << 128:
+                        raise ValueError(f"{key} doesn't fit in 128 bits: {value}")
+                    event_amounts.append((bit, value))
+                elif key == "timestamp":
+                    user_timestamps[j] = int(value)
+            masks[j] = mask
+
+            # amounts go in INT_FIELDS order, which is bit order
+            event_amounts.sort()
+            amounts.extend(value for _, value in event_amounts)
+
+        for key, values in user_codes.items():
+            code_columns[key][start:stop] = values
+        timestamps[start:stop] = user_timestamps
+        presence[start:stop] = masks
+
+        highs[amount_pos:amount_pos + len(amounts)] = [value >> 64 for value in amounts]
+        lows[amount_pos:amount_pos + len(amounts)] = [value & _LOW_MASK for value in amounts]
+        amount_pos += len(amounts)
+        amount_offsets[i + 1] = amount_pos
+
+        encoded = [(e.get("txn_id") or "").encode() for e in evs]
+        txn_offsets[start + 1:stop + 1] = txn_start + np.cumsum([len(s) for s in encoded], dtype=np.int64)
+        encoded = b"".join(encoded)
+        txn_blob[txn_start:txn_start + len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+        txn_start += len(encoded)
+
+        start = stop
+
+    # the table is only complete once every user is in, so it goes last
+    encoded = [s.encode() for s in table]
+    string_offsets = column("strings.offsets", len(encoded) + 1, np.int64, 0)
+    np.cumsum([len(s) for s in encoded], out=string_offsets[1:])
+    encoded = b"".join(encoded)
+    column("strings.blob", len(encoded), np.uint8)[...] = np.frombuffer(encoded, dtype=np.uint8)
+
+    return EventStore(columns)
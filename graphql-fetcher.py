@@ -1,8 +1,27 @@
 import sys
 import os
 import json
+import time
+import gzip
+import hashlib
 import requests
 import random
+from concurrent.futures import ThreadPoolExecutor
+
+
+GRAPHQL_URL = 'https://api.thegraph.com/subgraphs/name/aave/protocol-multy-raw'
+
+# the api will return at most this many records for a single selection
+PAGE_SIZE = 1000
+
+# raw response pages are cached here, one gzipped json file per request
+CACHE_DIR = "./data/cache/"
+
+# slices per request a batched fetch starts with, or keeps when the batch size is pinned
+BATCH_SIZE = 4
+
+# seconds to wait for a response, a batch that takes longer is retried with fewer slices
+REQUEST_TIMEOUT = 120
 
 
 def _get_event_type(out_dict):
@@ -27,10 +46,13 @@ def _get_event_type(out_dict):
 
 
 
-def process_response(json_data, depth=2, single_values=False):
+def process_response(json_data, depth=2, single_values=False, alias="userTransactions"):
     """
         process json response into a format that can be used for modeling.
 
+        `alias` picks which selection in the response to process, batched
+        queries return one aliased userTransactions list per timestamp slice.
+
         original:
             "data": {
                 "userTransactions": [
@@ -67,7 +89,7 @@ def process_response(json_data, depth=2, single_values=False):
     output = []
 
     # list of dicts
-    user_transactions = json_data["data"]["userTransactions"]
+    user_transactions = json_data["data"][alias]
 
     for data in user_transactions: 
 
@@ -89,6 +111,27 @@ def process_response(json_data, depth=2, single_values=False):
     return output
 
 
+def process_batch_response(json_data, depth=2, single_values=False):
+    """
+        demultiplex a batched response into processed events per alias.
+
+        original:
+            "data": {
+                "s0": [{...}, {...}],
+                "s1": [{...}, {...}]
+            }
+        processed:
+        {
+            "s0": [{processed event}, ...],
+            "s1": [{processed event}, ...]
+        }
+    """
+    return {
+        alias: process_response(json_data, depth, single_values=single_values, alias=alias)
+        for alias in json_data["data"]
+    }
+
+
 def _denest_data(data, target_depth, traversed_depth=0, initial_key=None, single_values=False):
     
     """
@@ -139,12 +182,8 @@ def _denest_data(data, target_depth, traversed_depth=0, initial_key=None, single
     return output
 
 
-def get_query(timestamp):
-    """
-        get a query string with a variable timestamp (for fetching multple queries)
-    """
-    return (
-r"""query Query($userTransactionsOrderBy: UserTransaction_orderBy) {userTransactions(first: 1000, orderBy: timestamp, where: {timestamp_lt:""" + str(timestamp) + r""" }, orderDirection: desc) {
+# fields selected for every userTransactions record, shared by the single and batched queries
+_TRANSACTION_FIELDS = r"""
     id
     timestamp
     user {
@@ -211,24 +250,233 @@ r"""query Query($userTransactionsOrderBy: UserTransaction_orderBy) {userTransact
         symbol
     }
   }
-}}
 """
-    ).rstrip("\n")
 
-def graphql_query(query):
+
+def _get_selection(timestamp, alias=None, timestamp_gte=None):
     """
-        Pass query to graphql endpoint and retrieve a json object.
+        get a single userTransactions selection for records older than `timestamp`.
+
+        `alias` names the selection so several can share one request, and
+        `timestamp_gte` bounds the selection to a timestamp slice.
     """
-    url = 'https://api.thegraph.com/subgraphs/name/aave/protocol-multy-raw'
+    where = "timestamp_lt:" + str(timestamp)
+    if timestamp_gte is not None:
+        where += ", timestamp_gte:" + str(timestamp_gte)
+
+    prefix = f"{alias}: " if alias else ""
+
+    return (
+        prefix + "userTransactions(first: " + str(PAGE_SIZE) + ", orderBy: timestamp, where: {" + where + " }, orderDirection: desc) {"
+        + _TRANSACTION_FIELDS + "}"
+    )
+
 
+def get_query(timestamp):
+    """
+        get a query string with a variable timestamp (for fetching multple queries)
+    """
+    return (
+        r"""query Query($userTransactionsOrderBy: UserTransaction_orderBy) {""" + _get_selection(timestamp) + "}"
+    )
+
+
+def get_batch_query(slices):
+    """
+        get a query string packing one aliased userTransactions selection per slice.
+
+        slices: {alias: (timestamp_gte, timestamp_lt)}
+
+        each alias pages through its own slice, so a single round trip can
+        return up to PAGE_SIZE records per slice.
+    """
+    selections = [
+        _get_selection(timestamp_lt, alias=alias, timestamp_gte=timestamp_gte)
+        for alias, (timestamp_gte, timestamp_lt) in slices.items()
+    ]
+    return "query Query {" + "\n".join(selections) + "}"
+
+
+def get_cache_key(payload):
+    """
+        key a request by its query text and variables, independent of the endpoint.
+    """
+    key_data = json.dumps(
+        {"query": payload.get("query"), "variables": payload.get("variables")},
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+def get_cache_path(key, cache_dir=CACHE_DIR):
+    """
+        location of a cached response page on disk.
+    """
+    return os.path.join(cache_dir, key + ".json.gz")
+
+
+def _read_cached_page(key, cache_dir=CACHE_DIR):
+    """
+        load a cached response page, returns None if it isn't on disk.
+    """
+    path = get_cache_path(key, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return json.loads(gzip.decompress(f.read()))
+
+
+def _is_rejected(json_data):
+    """
+        the api answers queries it can't serve with errors instead of data, or
+        with null data / null selections.
+    """
+    data = json_data.get("data")
+    return not isinstance(data, dict) or any(value is None for value in data.values())
+
+
+def _dumps(json_data):
+    """
+        compact json bytes for a cached page (CachedSession.post shadows the json module).
+    """
+    return json.dumps(json_data, separators=(",", ":")).encode()
+
+
+class _CachedResponse:
+    """
+        stand in for a requests response served from the cache.
+    """
+
+    status_code = 200
+
+    def __init__(self, json_data):
+        self._json_data = json_data
+
+    def json(self):
+        return self._json_data
+
+
+class CachedSession:
+    """
+        Drop in replacement for a requests session that caches raw response pages.
+
+        mode "refresh": always post to the endpoint and overwrite the stored
+                        page, so a recording picks up new records.
+        mode "resume": serve pages from disk when present, otherwise post to
+                       the endpoint and store the response, e.g. to finish
+                       an interrupted recording.
+        mode "replay": serve pages from disk only, a miss raises a KeyError.
+
+        Keys of every page served from or stored on disk are kept in order,
+        `save_manifest` writes them out so `replay_all_events` can rebuild
+        the fetch later. Rejected queries are passed through uncached.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, mode="refresh"):
+        if mode not in ("refresh", "resume", "replay"):
+            raise ValueError(f"unknown cache mode: {mode}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.keys = []
+        self._session = requests.Session()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        key = get_cache_key(json)
+        json_data = None if self.mode == "refresh" else _read_cached_page(key, self.cache_dir)
+
+        if json_data is None:
+            if self.mode == "replay":
+                raise KeyError(f"query not in response cache: {key}")
+
+            r = self._session.post(url, json=json, headers=headers, timeout=timeout)
+            if r.status_code != 200:
+                return r
+
+            # don't cache failed queries, they'd be served again on the next run
+            json_data = r.json()
+            if _is_rejected(json_data):
+                return _CachedResponse(json_data)
+
+            with open(get_cache_path(key, self.cache_dir), "wb") as f:
+                f.write(gzip.compress(_dumps(json_data)))
+
+        # only pages stored on disk go in the manifest, so replay can read every key
+        self.keys.append(key)
+        return _CachedResponse(json_data)
+
+    def save_manifest(self, **fetch_params):
+        """
+            write the keys served so far, with the fetch params (e.g. batch_size)
+            needed to send the same queries again.
+        """
+        with open(os.path.join(self.cache_dir, "manifest.json"), "wt") as f:
+            json.dump({"fetch_params": fetch_params, "keys": self.keys}, f, indent=2)
+
+
+def get_fetch_params(cache_dir=CACHE_DIR):
+    """
+        fetch params saved with the last recorded fetch, empty if nothing was recorded.
+    """
+    path = os.path.join(cache_dir, "manifest.json")
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["fetch_params"]
+
+
+def replay_all_events(cache_dir=CACHE_DIR):
+    """
+        rebuild all_events from the cached pages of the last recorded fetch, no network needed.
+
+        pages are read and decompressed on a thread pool, then demultiplexed
+        in manifest order so the output matches the recorded fetch.
+    """
+    with open(os.path.join(cache_dir, "manifest.json")) as f:
+        keys = json.load(f)["keys"]
+
+    def read_page(key):
+        with open(get_cache_path(key, cache_dir), "rb") as f:
+            return gzip.decompress(f.read())
+
+    events = {}
+    with ThreadPoolExecutor() as pool:
+        for raw_page in pool.map(read_page, keys):
+            for alias, event_batch in process_batch_response(json.loads(raw_page)).items():
+                events.setdefault(alias, []).extend(event_batch)
+
+    # aliases are first seen in slice order, newest first
+    return [event for event_batch in events.values() for event in event_batch]
+
+
+def _post_query(query, url=GRAPHQL_URL, session=requests, timeout=REQUEST_TIMEOUT):
+    """
+        Pass query to graphql endpoint and retrieve the raw json response.
+
+        timeouts, connection errors, http errors and non json bodies (e.g. a
+        gateway's html error page) come back as a graphql style error
+        response, like the queries the api rejects.
+    """
     headers = {'content-type': 'application/json'}
 
-    r = requests.post(url, json={'query': query.replace('\n', '')}, headers=headers)
-    processed_data = process_response(r.json())
+    try:
+        r = session.post(url, json={'query': query.replace('\n', '')}, headers=headers, timeout=timeout)
+        if r.status_code != 200:
+            return {"errors": [{"message": f"http status {r.status_code}"}]}
+        return r.json()
+    except (requests.RequestException, ValueError) as e:
+        return {"errors": [{"message": f"{type(e).__name__}: {e}"}]}
+
+
+def graphql_query(query, url=GRAPHQL_URL, session=requests):
+    """
+        Pass query to graphql endpoint and retrieve a json object.
+    """
+    processed_data = process_response(_post_query(query, url, session))
     return processed_data
     
 
-def grab_all_events():
+def grab_all_events(url=GRAPHQL_URL, session=requests):
     """
         This works around the 1000 record query limit with  the aave graphql api.
 
@@ -247,7 +495,7 @@ def grab_all_events():
 
 
         # call the graphql api with the desired query
-        event_batch = graphql_query(query)
+        event_batch = graphql_query(query, url, session)
 
         final_output.extend(event_batch)
         
@@ -273,6 +521,94 @@ def grab_all_events():
     
     return final_output
 
+
+def _adapt_batch_size(batch_size, elapsed, num_records, target_latency, max_batch_size, max_records):
+    """
+        grow the number of slices per request while responses come back fast
+        and small, and back off when they get slow or large.
+
+        with `target_latency` None only the response size counts, so the
+        batch size doesn't depend on timing.
+    """
+    slow = target_latency is not None and elapsed > target_latency
+    if slow or num_records > max_records:
+        return max(1, batch_size // 2)
+
+    if target_latency is None or elapsed < target_latency / 2:
+        return min(max_batch_size, batch_size * 2)
+
+    return batch_size
+
+
+def grab_all_events_batched(url=GRAPHQL_URL, num_slices=64, batch_size=BATCH_SIZE, max_batch_size=32, target_latency=10.0, max_records=20000, session=None):
+    """
+        Same records as grab_all_events, with fewer round trips.
+
+        The timestamp range is split into `num_slices` slices, each with its
+        own cursor. Every request packs one aliased userTransactions selection
+        per active slice, so a round trip returns up to PAGE_SIZE records for
+        each of them. A slice is done once it returns less than a full page.
+
+        The number of slices per request starts at `batch_size` and adapts to
+        the latency and size of the responses. Cached pages are keyed by the
+        whole query, so to send the same queries on every run (recording, or
+        fetching from the cache server) pin the batch size: set
+        `max_batch_size` equal to `batch_size` and `target_latency` to None.
+    """
+
+    oldest_timestamp = 1578505854
+    current_timestamp = 1911111111
+    step = -(-(current_timestamp - oldest_timestamp) // num_slices)
+
+    # per alias cursors: [timestamp_gte, timestamp_lt], newest slice first.
+    # the oldest slice is left open ended, like the single query fetch.
+    cursors = {}
+    for i in range(num_slices):
+        timestamp_lt = current_timestamp - i * step
+        timestamp_gte = timestamp_lt - step if i < num_slices - 1 else None
+        cursors[f"s{i}"] = [timestamp_gte, timestamp_lt]
+
+    events = {alias: [] for alias in cursors}
+    pending = list(cursors)
+    session = session or requests.Session()
+
+    while pending:
+        batch = pending[:batch_size]
+        query = get_batch_query({alias: tuple(cursors[alias]) for alias in batch})
+
+        start = time.time()
+        json_data = _post_query(query, url, session)
+        elapsed = time.time() - start
+
+        # the api rejects (or times out on) queries that get too large, retry with fewer slices
+        if _is_rejected(json_data):
+            if len(batch) == 1:
+                raise RuntimeError(f"graphql query failed: {json_data.get('errors')}")
+            batch_size = max(1, len(batch) // 2)
+            print(f"query rejected, retrying with {batch_size} slices per request")
+            continue
+
+        num_records = 0
+        done = set()
+        for alias, event_batch in process_batch_response(json_data).items():
+            events[alias].extend(event_batch)
+            num_records += len(event_batch)
+
+            # a short page means the slice has no records left
+            if len(event_batch) < PAGE_SIZE:
+                done.add(alias)
+            else:
+                cursors[alias][1] = min(int(e["timestamp"]) for e in event_batch)
+
+        pending = [alias for alias in pending if alias not in done]
+        print(f"{num_records} records from {len(batch)} slices in {elapsed:.2f}s, {len(pending)} slices left")
+
+        batch_size = _adapt_batch_size(batch_size, elapsed, num_records, target_latency, max_batch_size, max_records)
+
+    # slices are ordered newest first, so this keeps the descending order of grab_all_events
+    return [event for alias in cursors for event in events[alias]]
+
+
  
 def get_user_mapping(events):
     """
@@ -285,7 +621,13 @@ def get_user_mapping(events):
                 {},{},{}
             ]
         }
+
+        an EventStore from event-store.py is already grouped, its users come
+        back as UserEvents.
     """
+    if hasattr(events, "user_events"):
+        return dict(events.items())
+
     user_mapping = {}
 
     for event in events:
@@ -318,17 +660,42 @@ def get_test_data_mapping(test_data):
     test_data_mapping = get_user_mapping(test_data)
     return test_data_mapping
 
-def run_full_fetch():
+def run_full_fetch(url=GRAPHQL_URL, record=False, resume=False, batch_size=None, num_slices=64):
     """
         fetch data from api and save to disk.
+
+        with `record` set, every query goes to the endpoint and its raw
+        response page is written to CACHE_DIR, so the fetch can be replayed
+        without the network. `resume` records too, but serves the queries
+        already in the cache from disk and only fetches the missing ones.
+
+        a `batch_size` pins the number of slices per request instead of
+        adapting it to response times. Recording and fetching from another
+        url (the cache server) always pin it, by default to the batch size of
+        the last recording, so their queries match the cached pages.
     """
+    record = record or resume
+    if batch_size is None and (record or url != GRAPHQL_URL):
+        fetch_params = get_fetch_params()
+        batch_size = fetch_params.get("batch_size", BATCH_SIZE)
+        num_slices = fetch_params.get("num_slices", num_slices)
+
+    if batch_size is None:
+        fetch_kwargs = {}
+    else:
+        print(f"pinning the batch size to {batch_size} of {num_slices} slices")
+        fetch_kwargs = {"batch_size": batch_size, "max_batch_size": batch_size, "target_latency": None}
+
     print(f"Retrieving all events from graphql api...")
-    all_events = grab_all_events()
+    session = CachedSession(mode="resume" if resume else "refresh") if record else None
+    all_events = grab_all_events_batched(url, num_slices=num_slices, session=session, **fetch_kwargs)
+    if record:
+        session.save_manifest(batch_size=batch_size, num_slices=num_slices)
     
     print(f"events retrieved, saving to disk")
     with open("./data/all_events.json", "wt") as f:
         json.dump(all_events, f, indent=2)
-    return True
+    return all_events
 
 if __name__ == "__main__":
 
@@ -342,20 +709,38 @@ if __name__ == "__main__":
     else:
         print("data directory found")
 
-    # if the -fetch flag is set, fetch the data from the api
-    if sys.argv[1] == '--fetch':
-        run_full_fetch()
-
-    # if data is already present on disk, skip running a full fetch.
-    print("checking for event data on disk ...")
-    data_file = os.getcwd() + '/data/all_events.json' # get file location
-    if os.path.isfile(data_file):
-        print("\"all_events.json\" found, loading from disk.")
-        with open('./data/all_events.json') as f:
-            all_events = json.load(f)
-    else:
-        # if not data on disk, fetch the data from the api
-        run_full_fetch()
+    # --url points the fetch at another endpoint, e.g. the local cache-server.py
+    url = sys.argv[sys.argv.index('--url') + 1] if '--url' in sys.argv else GRAPHQL_URL
+
+    # --batch-size pins the slices per request, --record and --url pin it to the last recording's by default
+    batch_size = int(sys.argv[sys.argv.index('--batch-size') + 1]) if '--batch-size' in sys.argv else None
+
+    all_events = None
+
+    # if the --replay flag is set, rebuild the events from cached responses
+    if '--replay' in sys.argv:
+        print("replaying events from the response cache ...")
+        all_events = replay_all_events()
+        with open("./data/all_events.json", "wt") as f:
+            json.dump(all_events, f, indent=2)
+
+    # if the -fetch flag is set, fetch the data from the api, --record caches the responses,
+    # --resume only fetches the responses that aren't cached yet
+    elif '--fetch' in sys.argv:
+        all_events = run_full_fetch(url, record='--record' in sys.argv, resume='--resume' in sys.argv, batch_size=batch_size)
+
+    # if data is already present on disk, skip running a full fetch. Replayed or
+    # fetched events are already in memory, so the file they were saved to isn't parsed again
+    if all_events is None:
+        print("checking for event data on disk ...")
+        data_file = os.getcwd() + '/data/all_events.json' # get file location
+        if os.path.isfile(data_file):
+            print("\"all_events.json\" found, loading from disk.")
+            with open('./data/all_events.json') as f:
+                all_events = json.load(f)
+        else:
+            # if not data on disk, fetch the data from the api
+            all_events = run_full_fetch(url, record='--record' in sys.argv, resume='--resume' in sys.argv, batch_size=batch_size)
         
 
     # create mapping of user transasction from event logs
@@ -0,0 +1,38 @@
+import time
+import datetime
+
+
+# model and train / test split shared by the credit scoring scripts and run-pipeline.py
+
+MD = 3 # max depth for the treess
+NE = 200 # number of trees in the gradient boosting model
+TD = 2.0 # total distance searched by the gradient boosting iteration
+
+MODEL_PARAMS = {
+    "n_estimators" : NE,
+    'boosting_type': 'gbdt',
+    'objective': 'binary',
+    'num_leaves': int(2**MD),
+    'learning_rate': TD/NE,
+    'feature_fraction': 1.0,
+    'bagging_fraction': 1.0,
+    'verbose': 0,
+    'max_depth': MD
+}
+
+# the out of time split of 03-credit-scoring-aggressive-randomize.py
+SPLIT_PARAMS = {
+    "seed": 1234,
+    "train_frac": 0.66, # 2/3 of data used to train
+
+    # set this to True for the more aggressive test, train and test on different years
+    "out_of_time_test": True,
+
+    # set this to enforce at least 3 months of future data, this eliminates
+    # another possible "cheat"
+    "enforce_3months_future": True,
+
+    # relevant cutoff dates
+    "jan_1_2021": time.mktime(datetime.datetime(2021,1,1).timetuple()),
+    "apr_15_2021": time.mktime(datetime.datetime(2021,4,15).timetuple()),
+}
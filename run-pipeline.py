@@ -0,0 +1,480 @@
+import os
+import sys
+import json
+import random
+import hashlib
+import inspect
+import importlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import lightgbm
+import numpy as np
+import scipy.sparse
+from sklearn.metrics import roc_auc_score
+
+# same as "from graphql-fetcher import ..."
+fetcher = importlib.import_module('graphql-fetcher')
+
+# same as "from 01-feature-engineering import get_features_and_label, ReserveFeatures"
+feature_engineering = importlib.import_module('01-feature-engineering')
+
+# same as "from event-store import load_user_mapping"
+event_store = importlib.import_module('event-store')
+
+# same as "from model-params import SPLIT_PARAMS, MODEL_PARAMS", the split and model of 03
+model_params = importlib.import_module('model-params')
+SPLIT_PARAMS = model_params.SPLIT_PARAMS
+MODEL_PARAMS = model_params.MODEL_PARAMS
+
+
+DATA_DIR = "./data"
+CACHE_DIR = os.path.normpath(fetcher.CACHE_DIR)
+EVENTS_FILE = os.path.join(DATA_DIR, "all_events.json")
+USER_MAPPING_FILE = os.path.join(DATA_DIR, "all_user_mapping.json")
+FEATURES_FILE = os.path.join(DATA_DIR, "features.npz")
+FEATURES_META_FILE = os.path.join(DATA_DIR, "features.json")
+MODEL_FILE = os.path.join(DATA_DIR, "model.txt")
+RESERVE_COLUMNS_FILE = os.path.join(DATA_DIR, "reserve_columns.json")
+METRICS_FILE = os.path.join(DATA_DIR, "metrics.json")
+SHAP_IMPORTANCE_FILE = os.path.join(DATA_DIR, "shap_importance_test.json")
+
+
+# ---------------------------------------------------------------------------
+# stages, each reads its inputs from disk and writes its outputs to disk
+# ---------------------------------------------------------------------------
+
+def run_fetch(params):
+    """
+        fetch every page from the api into the response cache.
+
+        the batch size is pinned so the recorded queries can be served again
+        by cache-server.py.
+    """
+    session = fetcher.CachedSession(mode="refresh")
+    fetcher.grab_all_events_batched(
+        params["url"], num_slices=params["num_slices"], session=session,
+        batch_size=params["batch_size"], max_batch_size=params["batch_size"], target_latency=None,
+    )
+    session.save_manifest(batch_size=params["batch_size"], num_slices=params["num_slices"])
+
+
+def run_flatten(params):
+    """
+        rebuild the flattened events from the cached pages.
+    """
+    all_events = fetcher.replay_all_events()
+    with open(EVENTS_FILE, "wt") as f:
+        json.dump(all_events, f, indent=2)
+
+
+def run_group(params):
+    """
+        group events by user.
+    """
+    with open(EVENTS_FILE) as f:
+        all_events = json.load(f)
+    user_mapping = fetcher.get_user_mapping(all_events)
+    with open(USER_MAPPING_FILE, "wt") as f:
+        json.dump(user_mapping, f, indent=2)
+
+
+def extract_features(users, per_reserve=True):
+    """
+        features and labels at every borrow event, for every user.
+
+        returns the feature matrix (dense features, then the reserve columns),
+        labels, timestamps and the index of each row's user in `users`.
+    """
+    R = feature_engineering.ReserveFeatures()
+    dense_names = None
+    dense, labels, timestamps, user_index = [], [], [], []
+
+    for i, usr in enumerate(users):
+        evs = users[usr] # sorted by timestamp when loaded
+
+        # read the two columns the loop needs, rather than decoding whole events
+        for event_type, timestamp in zip(evs.columns["event_type"], evs.columns["timestamp"]):
+            if event_type != "borrow": continue
+
+            feats = feature_engineering.get_features_and_label(evs, timestamp, per_reserve=per_reserve)
+            if per_reserve:
+                feats, reserve_feats = feats
+                R.add_row(reserve_feats)
+
+            labels.append(float(feats.pop("label")))
+            dense_names = dense_names or list(feats)
+            dense.append([float(feats[fk]) for fk in dense_names])
+            timestamps.append(timestamp)
+            user_index.append(i)
+
+    X = scipy.sparse.csr_matrix(np.array(dense, dtype=np.float64).reshape(len(dense), len(dense_names or [])))
+    if per_reserve:
+        X = scipy.sparse.hstack([X, R.to_csr()], format="csr")
+    return X, dense_names or [], R, np.array(labels), np.array(timestamps, dtype=np.int64), np.array(user_index, dtype=np.int64)
+
+
+def run_features(params):
+    """
+        build the feature matrix for every borrow event.
+    """
+    users = event_store.load_user_mapping(USER_MAPPING_FILE)
+    X, dense_names, R, labels, timestamps, user_index = extract_features(users, params["per_reserve"])
+
+    np.savez(
+        FEATURES_FILE,
+        data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape),
+        label=labels, timestamp=timestamps, user_index=user_index,
+    )
+    with open(FEATURES_META_FILE, "wt") as f:
+        json.dump({
+            "columns": dense_names + R.feature_names(users.table),
+            "reserve_columns": R.column_keys(users.table),
+            "users": list(users),
+        }, f, indent=2)
+
+
+def load_features():
+    """
+        load the feature matrix and its row / column metadata written by the features stage.
+    """
+    with np.load(FEATURES_FILE) as f:
+        X = scipy.sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        rows = {key: f[key] for key in ("label", "timestamp", "user_index")}
+    with open(FEATURES_META_FILE) as f:
+        meta = json.load(f)
+    return X, rows, meta
+
+
+def split_rows(rows, meta, params):
+    """
+        train / test masks over the feature rows, same split as 03.
+
+        users are randomly assigned to train or test, in the order they
+        appear in the user mapping. The out of time test trains on events
+        before Jan 1 2021 and tests on the ones after.
+    """
+    random.seed(params["seed"])
+    train_users = np.array([random.uniform(0,1) < params["train_frac"] for _ in meta["users"]], dtype=bool)
+    is_train = train_users[rows["user_index"]] if len(rows["user_index"]) else np.zeros(0, dtype=bool)
+    ts = rows["timestamp"]
+
+    keep = np.ones(len(ts), dtype=bool)
+    if params["enforce_3months_future"]:
+        keep &= ts <= params["apr_15_2021"]
+
+    train, test = keep & is_train, keep & ~is_train
+    if params["out_of_time_test"]:
+        train &= ts <= params["jan_1_2021"]
+        test &= ts >= params["jan_1_2021"]
+    return train, test
+
+
+def run_train(params):
+    """
+        train the model on the training split and save it with its reserve column layout.
+    """
+    X, rows, meta = load_features()
+    train, _ = split_rows(rows, meta, params["split"])
+
+    TR = lightgbm.Dataset(X[train], label=rows["label"][train], feature_name=meta["columns"])
+    model = lightgbm.train(params["model"], TR)
+
+    model.save_model(MODEL_FILE)
+    with open(RESERVE_COLUMNS_FILE, "wt") as f:
+        json.dump(meta["reserve_columns"], f, indent=2)
+
+
+def run_evaluate(params):
+    """
+        ROC AUC of the saved model on the test split.
+    """
+    X, rows, meta = load_features()
+    _, test = split_rows(rows, meta, params["split"])
+
+    model = lightgbm.Booster(model_file=MODEL_FILE)
+    preds = model.predict(X[test])
+
+    with open(METRICS_FILE, "wt") as f:
+        json.dump({"roc_auc": roc_auc_score(rows["label"][test], preds), "num_test": int(test.sum())}, f, indent=2)
+
+
+def run_shap_importance(params):
+    """
+        mean absolute feature contribution (pred_contrib) over the test split.
+
+        this is the TreeSHAP importance 05-bulk-scoring.py --explain writes,
+        not 04's drop in test AUC from retraining without each feature.
+    """
+    X, rows, meta = load_features()
+    _, test = split_rows(rows, meta, params["split"])
+
+    model = lightgbm.Booster(model_file=MODEL_FILE)
+    contrib = scipy.sparse.csr_matrix(model.predict(X[test], pred_contrib=True))
+    mean_abs = np.asarray(abs(contrib).mean(axis=0)).ravel()
+
+    with open(SHAP_IMPORTANCE_FILE, "wt") as f:
+        json.dump(dict(zip(meta["columns"], mean_abs[:-1].tolist())), f, sort_keys=True, indent=2)
+
+
+# ---------------------------------------------------------------------------
+# the dag, stages run in order of their deps
+# ---------------------------------------------------------------------------
+
+# inputs / outputs are paths (files or directories), code is the modules the
+# stage imports (hashed whole, constants and helpers included) and the
+# functions of this file it runs. Only what a stage declares goes into its
+# fingerprint, so e.g. a model param change leaves the features alone.
+STAGES = {
+    "fetch": {
+        "run": run_fetch,
+        "deps": [],
+        "inputs": [],
+        "outputs": [CACHE_DIR],
+        "code": [fetcher, run_fetch],
+        "params": {
+            "url": fetcher.GRAPHQL_URL, "num_slices": 64, "batch_size": fetcher.BATCH_SIZE,
+            "fields": fetcher._TRANSACTION_FIELDS,
+        },
+    },
+    "flatten": {
+        "run": run_flatten,
+        "deps": ["fetch"],
+        "inputs": [CACHE_DIR],
+        "outputs": [EVENTS_FILE],
+        "code": [fetcher, run_flatten],
+        "params": {},
+    },
+    "group": {
+        "run": run_group,
+        "deps": ["flatten"],
+        "inputs": [EVENTS_FILE],
+        "outputs": [USER_MAPPING_FILE],
+        "code": [fetcher, run_group],
+        "params": {},
+    },
+    "features": {
+        "run": run_features,
+        "deps": ["group"],
+        "inputs": [USER_MAPPING_FILE],
+        "outputs": [FEATURES_FILE, FEATURES_META_FILE],
+        "code": [event_store, feature_engineering, extract_features, run_features],
+        "params": {"per_reserve": True},
+    },
+    "train": {
+        "run": run_train,
+        "deps": ["features"],
+        "inputs": [FEATURES_FILE, FEATURES_META_FILE],
+        "outputs": [MODEL_FILE, RESERVE_COLUMNS_FILE],
+        "code": [model_params, load_features, split_rows, run_train],
+        "params": {"split": SPLIT_PARAMS, "model": MODEL_PARAMS},
+    },
+    "evaluate": {
+        "run": run_evaluate,
+        "deps": ["train"],
+        "inputs": [FEATURES_FILE, FEATURES_META_FILE, MODEL_FILE],
+        "outputs": [METRICS_FILE],
+        "code": [model_params, load_features, split_rows, run_evaluate],
+        "params": {"split": SPLIT_PARAMS},
+    },
+    "shap_importance": {
+        "run": run_shap_importance,
+        "deps": ["train"],
+        "inputs": [FEATURES_FILE, FEATURES_META_FILE, MODEL_FILE],
+        "outputs": [SHAP_IMPORTANCE_FILE],
+        "code": [model_params, load_features, split_rows, run_shap_importance],
+        "params": {"split": SPLIT_PARAMS},
+    },
+}
+
+
+# ---------------------------------------------------------------------------
+# fingerprints
+# ---------------------------------------------------------------------------
+
+def _get_record_path(name):
+    """
+        fingerprints are kept next to the stage's first output, e.g. data/.features.stage.json
+    """
+    return os.path.join(os.path.dirname(STAGES[name]["outputs"][0]), f".{name}.stage.json")
+
+
+def _load_record(name):
+    path = _get_record_path(name)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _hash_file(path, known):
+    """
+        sha256 of a file, reusing the recorded hash if size and mtime haven't changed.
+    """
+    stat = os.stat(path)
+    previous = known.get(path)
+    if previous and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+        return previous
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+def _hash_paths(paths, known):
+    """
+        file hashes for a list of files and directories, None for missing paths.
+    """
+    hashes = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file_name in sorted(files):
+                    file_path = os.path.join(root, file_name)
+                    hashes[file_path] = _hash_file(file_path, known)
+        elif os.path.isfile(path):
+            hashes[path] = _hash_file(path, known)
+        else:
+            hashes[path] = None
+    return hashes
+
+
+def _hash_code_and_params(stage):
+    """
+        hash of the source of the stage's code and of its params.
+
+        modules are hashed as whole files, so a changed constant or helper
+        (e.g. event-store.py's INT_FIELDS) makes the stage stale too.
+    """
+    digest = hashlib.sha256()
+    for obj in stage["code"]:
+        digest.update(inspect.getsource(obj).encode())
+    digest.update(json.dumps(stage["params"], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _content(hashes):
+    # only the content hashes matter for staleness, size / mtime just save rehashing
+    return {path: h and h["sha256"] for path, h in hashes.items()}
+
+
+def get_fingerprint(name):
+    """
+        current fingerprint of a stage: its inputs, code and params.
+    """
+    stage = STAGES[name]
+    record = _load_record(name) or {}
+    inputs = _hash_paths(stage["inputs"], record.get("inputs", {}))
+    return {"inputs": inputs, "code_and_params": _hash_code_and_params(stage)}
+
+
+def is_up_to_date(name, fingerprint):
+    """
+        a stage is up to date if its inputs, code and params match the record
+        and its outputs are still the ones it wrote.
+    """
+    record = _load_record(name)
+    if record is None:
+        return False
+    if record["code_and_params"] != fingerprint["code_and_params"]:
+        return False
+    if _content(record["inputs"]) != _content(fingerprint["inputs"]):
+        return False
+
+    outputs = _hash_paths(STAGES[name]["outputs"], record["outputs"])
+    return None not in outputs.values() and _content(outputs) == _content(record["outputs"])
+
+
+def save_record(name, fingerprint):
+    record = dict(fingerprint, outputs=_hash_paths(STAGES[name]["outputs"], {}))
+    with open(_get_record_path(name), "wt") as f:
+        json.dump(record, f, indent=2)
+
+
+# ---------------------------------------------------------------------------
+# runner
+# ---------------------------------------------------------------------------
+
+def _get_needed(targets):
+    """
+        the targets and everything upstream of them.
+    """
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in STAGES:
+            raise ValueError(f"unknown stage: {name}, choose from {list(STAGES)}")
+        if name not in needed:
+            needed.add(name)
+            todo.extend(STAGES[name]["deps"])
+    return needed
+
+
+def run_pipeline(targets=None, force=(), max_workers=None):
+    """
+        run the stages needed for `targets` (default: all), skipping up to date ones.
+
+        a stage is checked once its deps are done, since their outputs are
+        its inputs. Stages whose deps are done run concurrently in worker
+        processes, e.g. evaluate and shap_importance after train.
+        Returns the names of the stages that ran.
+    """
+    needed = _get_needed(targets or list(STAGES))
+    done = set()
+    ran = []
+    running = {}
+
+    with ProcessPoolExecutor(max_workers) as pool:
+        while len(done) < len(needed):
+            ready = [
+                name for name in STAGES
+                if name in needed and name not in done and name not in running.values()
+                and all(dep in done for dep in STAGES[name]["deps"])
+            ]
+
+            for name in ready:
+                fingerprint = get_fingerprint(name)
+                if name not in force and is_up_to_date(name, fingerprint):
+                    print(f"[{name}] up to date, skipping")
+                    done.add(name)
+                    continue
+
+                print(f"[{name}] running ...")
+                future = pool.submit(STAGES[name]["run"], STAGES[name]["params"])
+                future.fingerprint = fingerprint
+                running[future] = name
+
+            # skipping stages can make others ready, check again before waiting
+            if not running or any(
+                name not in done and name not in running.values()
+                and all(dep in done for dep in STAGES[name]["deps"])
+                for name in needed
+            ):
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result() # re raise a stage's error here
+                save_record(name, future.fingerprint)
+                print(f"[{name}] done")
+                done.add(name)
+                ran.append(name)
+
+    return ran
+
+
+if __name__ == "__main__":
+
+    # usage: python run-pipeline.py [stage ...] [--force stage ...]
+    #   with no stages, runs everything. --force reruns a stage even if it's up to date,
+    #   e.g. --force fetch to pull new data from the api.
+    args = sys.argv[1:]
+    force = args[args.index("--force") + 1:] if "--force" in args else []
+    targets = args[:args.index("--force")] if "--force" in args else args
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    ran = run_pipeline(targets or None, force=force)
+    print(f"ran: {ran}" if ran else "everything up to date")
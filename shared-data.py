@@ -0,0 +1,143 @@
+import sys
+import atexit
+import importlib
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# same as "from event-store import EventStore"
+event_store = importlib.import_module('event-store')
+
+# attaching processes shouldn't unlink segments they don't own (python 3.13+ only),
+# on older versions start workers from the owning process so they share its resource tracker
+_ATTACH_KWARGS = {"track": False} if sys.version_info >= (3, 13) else {}
+
+# segments attached in this process, kept open for as long as the arrays using them
+_ATTACHED = {}
+
+
+class SharedDataset:
+    """
+        Owns the shared memory segments handed to worker processes.
+
+        share_frame / share_events copy data into shared memory once, and
+        load_events builds an event store there directly. Each returns a
+        small picklable spec. Workers pass the spec to attach_frame /
+        attach_events to get read only views by name, so memory doesn't grow
+        with the number of workers.
+
+        Segments are unlinked on close, at interpreter exit, or by the
+        multiprocessing resource tracker if this process crashes.
+
+            with SharedDataset() as ds:
+                spec = ds.share_frame(df)
+                pool.map(work, [(spec, i) for i in range(n)])
+    """
+
+    def __init__(self):
+        self._segments = []
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def allocate(self, shape, dtype):
+        """
+            new empty array in its own segment, returns (array, spec).
+
+            the array must be dropped before the segment is closed.
+        """
+        dtype = np.dtype(dtype)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self._segments.append(shm)
+
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return array, {"name": shm.name, "dtype": dtype.str, "shape": array.shape}
+
+    def share_array(self, array):
+        """
+            copy a numpy array into a new segment, returns its spec.
+        """
+        array = np.ascontiguousarray(array)
+        shared, spec = self.allocate(array.shape, array.dtype)
+        shared[...] = array
+        return spec
+
+    def share_frame(self, df):
+        """
+            share a feature DataFrame, every column is stored as float64.
+        """
+        return {
+            "columns": list(df.columns),
+            "values": self.share_array(df.to_numpy(dtype=np.float64)),
+        }
+
+    def share_events(self, store):
+        """
+            copy the columns of an EventStore (event-store.load_user_mapping) into shared memory.
+        """
+        return {name: self.share_array(array) for name, array in store.columns.items()}
+
+    def load_events(self, path):
+        """
+            load a user mapping file straight into shared memory, returns
+            (store, spec), the EventStore over the owned segments and the
+            spec for attach_events.
+
+            event-store.load_user_mapping streams the file and allocates each
+            column in its own segment, so there's no private copy of the
+            events to share afterwards. Like allocate's arrays, the store must
+            be dropped before the segments are closed.
+        """
+        spec = {}
+
+        def allocate(name, shape, dtype):
+            array, spec[name] = self.allocate(shape, dtype)
+            return array
+
+        store = event_store.load_user_mapping(path, allocate)
+        return store, spec
+
+    def close(self):
+        """
+            release and unlink every segment, safe to call more than once.
+        """
+        while self._segments:
+            shm = self._segments.pop()
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def attach_array(spec):
+    """
+        read only numpy view of a shared array.
+    """
+    shm = _ATTACHED.get(spec["name"])
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=spec["name"], **_ATTACH_KWARGS)
+        _ATTACHED[spec["name"]] = shm
+
+    array = np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=shm.buf)
+    array.flags.writeable = False
+    return array
+
+
+def attach_frame(spec):
+    """
+        DataFrame over a shared feature matrix, without copying it.
+    """
+    return pd.DataFrame(attach_array(spec["values"]), columns=spec["columns"], copy=False)
+
+
+def attach_events(spec):
+    """
+        EventStore over columns shared with SharedDataset.share_events, without copying them.
+    """
+    return event_store.EventStore({name: attach_array(array_spec) for name, array_spec in spec.items()})